@@ -1,11 +1,12 @@
 #!/usr/bin/env python3.7
 
-## in WDL: ${task1_script} ${token_outprefix} ${loom_inpath} ${gene_median_dictionary_pkl} ${token_dictionary_pkl}
+## in WDL: ${task1_script} ${token_outprefix} ${loom_inpath} ${gene_median_dictionary_pkl} ${token_dictionary_pkl} ${cpu}
 ## 0th argument = task1 script (i.e. path to this script)
 ## first argument = sys.argv[1] (token_outprefix)
 ## second argument = sys.argv[2] (loom_inpath)
 ## third argument = sys.argv[3] (gene_median_dictionary_pkl)
 ## fourth argument = sys.argv[4] (token_dictionary_pkl)
+## fifth argument = sys.argv[5] (cpu, optional: the task's cpu count, used as the number of worker processes)
 
 
 from __future__ import annotations
@@ -21,7 +22,11 @@ try:
 except ImportError:
     from typing_extensions import Literal
 
+import hashlib
 import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 from pathlib import Path
 
 import logging
@@ -32,8 +37,12 @@ warnings.filterwarnings("ignore", message=".*The 'nopython' keyword.*")
 import anndata as ad
 import loompy as lp
 import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import scipy.sparse as sp
-from datasets import Dataset
+from datasets import Dataset, Features, Sequence, Value, concatenate_datasets
+from datasets.arrow_writer import ArrowWriter
 import sys # sys must be imported for use of sys.argv below
 
 logger = logging.getLogger(__name__)
@@ -42,24 +51,180 @@ logger = logging.getLogger(__name__)
 GENE_MEDIAN_FILE = sys.argv[3]
 TOKEN_DICTIONARY_FILE = sys.argv[4]
 
-def rank_genes(gene_vector, gene_tokens):
+def tokenize_csr(X, gene_tokens, max_len=2048):
     """
-    Rank gene expression vector.
+    Convert a CSR matrix of normalized expression (cells x genes) to tokenized
+    rank value encodings, keeping the top max_len genes of each cell.
+    Returns a flat token buffer and per-cell offsets into it.
     """
-    # sort by median-scaled gene values
-    sorted_indices = np.argsort(-gene_vector)
-    return gene_tokens[sorted_indices]
+    # float32 keys let numpy dispatch its vectorized argsort kernels (a no-op after normalize_csr)
+    data = X.data.astype(np.float32, copy=False)
+    indices = X.indices
+    indptr = X.indptr
+
+    # row r's tokens land in out_ids[out_offsets[r]:out_offsets[r + 1]]
+    row_lens = np.minimum(np.diff(indptr), max_len)
+    out_offsets = np.zeros(X.shape[0] + 1, dtype=np.int64)
+    np.cumsum(row_lens, out=out_offsets[1:])
+    out_ids = np.empty(out_offsets[-1], dtype=gene_tokens.dtype)
+
+    for r in range(X.shape[0]):
+        s, e = indptr[r], indptr[r + 1]
+        keys = -data[s:e]
+        if e - s > max_len:
+            # only the top max_len genes survive truncation, so partition first
+            top = np.argpartition(keys, max_len)[:max_len]
+            order = top[np.argsort(keys[top])]
+        else:
+            order = np.argsort(keys)
+        out_ids[out_offsets[r]:out_offsets[r + 1]] = gene_tokens[indices[s:e][order]]
+    return out_ids, out_offsets
+
+
+def normalize_csr(X, n_counts, norm_factor_vector, target_sum):
+    """
+    Normalize a CSR matrix of counts (cells x genes) in place: divide by total
+    counts per cell, scale to target_sum and divide by gene normalization
+    factors, touching only the stored nonzero entries.
+    Values are computed in float32: only their rank order is used downstream.
+    """
+    # explicitly stored zeros are undetected genes, not tokens
+    X.eliminate_zeros()
+    row_of_nnz = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    cell_scale = (target_sum / n_counts).astype(np.float32)
+    X.data = X.data.astype(np.float32, copy=False)
+    X.data *= cell_scale[row_of_nnz]
+    X.data /= norm_factor_vector.astype(np.float32, copy=False)[X.indices]
+    return X
+
+
+# cells per read window: loompy's default scan batch (8 of loom's 64-cell HDF5 chunks),
+# read densely as all genes x window cells, so it also bounds per-worker memory
+READ_WINDOW = 512
+
+
+def _window_blocks(positions, block_size, window_size=READ_WINDOW):
+    """
+    Split sorted positions into blocks of about block_size positions, breaking
+    only between window_size-aligned windows so no window spans two blocks.
+    """
+    window_starts = np.flatnonzero(np.diff(positions // window_size)) + 1
+    breaks = []
+    block_start = 0
+    for start in window_starts:
+        if start - block_start >= block_size:
+            breaks.append(start)
+            block_start = start
+    return np.split(positions, breaks) if len(positions) else []
+
+
+def _stack_csr(blocks):
+    """
+    Stack CSR blocks row-wise, returning a lone block as is rather than rebuilding it.
+    """
+    if len(blocks) == 1:
+        return blocks[0]
+    return sp.vstack(blocks, format="csr")
+
+
+# worker processes are spawned fresh rather than forked: importing loompy starts Numba's
+# threading layer in the parent, which a forked child can deadlock on
+_mp_context = multiprocessing.get_context("spawn")
 
 
-def tokenize_cell(gene_vector, gene_tokens):
+# per-process state for chunk workers (open file handle plus gene-axis vectors),
+# set once per worker by _init_chunk_worker so chunks only carry cell indices and counts
+_chunk_worker = {}
+
+
+def _init_chunk_worker(
+    file_path,
+    file_format,
+    coding_miRNA_loc,
+    coding_miRNA_tokens,
+    norm_factor_vector,
+    target_sum,
+):
+    """
+    Open file_path read-only and store the gene-axis vectors for _tokenize_chunk.
     """
-    Convert normalized gene expression vector to tokenized rank value encoding.
+    if file_format == "loom":
+        data = lp.connect(str(file_path), mode="r", validate=False)
+    else:
+        data = ad.read(file_path, backed="r")
+    _chunk_worker.update(
+        data=data,
+        file_format=file_format,
+        coding_miRNA_loc=coding_miRNA_loc,
+        coding_miRNA_tokens=coding_miRNA_tokens,
+        norm_factor_vector=norm_factor_vector,
+        target_sum=target_sum,
+    )
+
+
+def _close_chunk_worker():
     """
-    # create array of gene vector with token indices
-    # mask undetected genes
-    nonzero_mask = np.nonzero(gene_vector)[0]
-    # rank by median-scaled gene values
-    return rank_genes(gene_vector[nonzero_mask], gene_tokens[nonzero_mask])
+    Close the file handle opened by _init_chunk_worker.
+    """
+    data = _chunk_worker.pop("data")
+    if _chunk_worker["file_format"] == "loom":
+        data.close()
+    else:
+        data.file.close()
+
+
+def _tokenize_chunk(chunk):
+    """
+    Tokenize the cells at positions idx of the worker's open file, given
+    chunk = (idx, n_counts). Returns the tokenized cells as an Arrow list array.
+    """
+    idx, n_counts = chunk
+    data = _chunk_worker["data"]
+    coding_miRNA_loc = _chunk_worker["coding_miRNA_loc"]
+    coding_miRNA_tokens = _chunk_worker["coding_miRNA_tokens"]
+    norm_factor_vector = _chunk_worker["norm_factor_vector"]
+    target_sum = _chunk_worker["target_sum"]
+
+    if _chunk_worker["file_format"] == "loom":
+        # scan the main matrix only, in the READ_WINDOW-aligned windows the chunk was split on
+        blocks = []
+        for (_ix, _selection, view) in data.scan(
+            items=idx, axis=1, layers=[""], what=["layers"], batch_size=READ_WINDOW
+        ):
+            # protein-coding and miRNA genes straight from the main layer (no subview copy),
+            # as CSR rows per cell with undetected genes dropped; the transpose of the
+            # genes x cells CSC reuses its buffers as CSR instead of re-sparsifying a transposed copy
+            blocks.append(sp.csc_matrix(view[coding_miRNA_loc, :]).T)
+        X_view = _stack_csr(blocks)
+    else:
+        # one contiguous read of the rows spanning each of the chunk's READ_WINDOW-aligned
+        # windows rather than a backed read per run of passing cells; a dense X is read across
+        # all genes, so windows bound that read and each is kept as sparse rows
+        blocks = []
+        for window in np.split(idx, np.flatnonzero(np.diff(idx // READ_WINDOW)) + 1):
+            block = data.X[window[0]:window[-1] + 1][window - window[0]]
+            blocks.append(block.tocsr() if sp.issparse(block) else sp.csr_matrix(block))
+        # protein-coding and miRNA genes, selected once on the stacked chunk
+        X_view = _stack_csr(blocks)[:, coding_miRNA_loc]
+
+    # normalize by total counts per cell and multiply by 10,000 to allocate bits to precision
+    # and normalize by gene normalization factors
+    X_norm = normalize_csr(X_view, n_counts, norm_factor_vector, target_sum)
+
+    # flat token buffer + offsets is already Arrow's list layout, so no per-cell arrays
+    out_ids, out_offsets = tokenize_csr(X_norm, coding_miRNA_tokens)
+    return pa.ListArray.from_arrays(out_offsets.astype(np.int32), out_ids)
+
+
+def _tokenize_file_to_arrow(tokenizer, file_path, file_format, arrow_path, features):
+    """
+    Tokenize one file into arrow_path in a file-level worker process. Its chunks
+    run in-process, so file workers don't spawn nested pools.
+    """
+    tokenizer.nproc = 1
+    tokenizer.create_dataset(
+        tokenizer.tokenize_files(file_path, file_format), arrow_path, features
+    )
 
 
 class TranscriptomeTokenizer:
@@ -79,7 +244,7 @@ class TranscriptomeTokenizer:
             Keys are the names of the attributes in the loom file.
             Values are the names of the attributes in the dataset.
         nproc : int
-            Number of processes to use for dataset mapping.
+            Number of processes to use for tokenization.
         gene_median_file : Path
             Path to pickle file containing dictionary of non-zero median
             gene expression values across Genecorpus-30M.
@@ -89,7 +254,7 @@ class TranscriptomeTokenizer:
         # dictionary of custom attributes {output dataset column name: input .loom column name}
         self.custom_attr_name_dict = custom_attr_name_dict
 
-        # number of processes for dataset mapping
+        # number of processes for chunk tokenization
         self.nproc = nproc
 
         # load dictionary of gene normalization factors
@@ -104,8 +269,13 @@ class TranscriptomeTokenizer:
         # gene keys for full vocabulary
         self.gene_keys = list(self.gene_median_dict.keys())
 
-        # protein-coding and miRNA gene list dictionary for selecting .loom rows for tokenization
-        self.genelist_dict = dict(zip(self.gene_keys, [True] * len(self.gene_keys)))
+        # vectorized lookups over the gene axis (hash joins in pandas instead of per-gene dict access)
+        self._keys_arr = np.asarray(self.gene_keys)
+        self._median_series = pd.Series(self.gene_median_dict, dtype=np.float32)
+        self._token_series = pd.Series(self.gene_token_dict, dtype=np.int32)
+
+        # gene-axis vectors per distinct ensembl_id axis, keyed by its digest
+        self._gene_axis_cache = {}
 
     def tokenize_data(
         self,
@@ -120,7 +290,8 @@ class TranscriptomeTokenizer:
         Parameters
         ----------
         loom_data_directory : Path
-            Path to directory containing loom files or anndata files
+            Path to directory containing loom files or anndata files, or to a single file.
+            Multiple files are tokenized concurrently when nproc > 1.
         output_directory : Path
             Path to directory where tokenized data will be saved as .dataset
         output_prefix : str
@@ -128,85 +299,173 @@ class TranscriptomeTokenizer:
         file_format : str
             Format of input files. Can be "loom" or "h5ad".
         use_generator : bool
-            Whether to use generator or dict for tokenization.
+            Unused; tokenized cells are always streamed to an Arrow file
+            as one record batch per chunk of cells. Kept for backwards
+            compatibility.
         """
-        tokenized_cells, cell_metadata = self.tokenize_files(
-            Path(data_directory), file_format
-        )
-        tokenized_dataset = self.create_dataset(tokenized_cells, cell_metadata, use_generator=use_generator)
+        data_directory = Path(data_directory)
+        output_directory = Path(output_directory)
+        output_directory.mkdir(parents=True, exist_ok=True)
+
+        file_paths = self._data_files(data_directory, file_format)
+        features = self._dataset_features(file_paths[0], file_format)
+        n_file_workers = min(self.nproc, len(file_paths))
+        if n_file_workers > 1:
+            # tokenize files concurrently, each into its own Arrow shard
+            arrow_paths = [
+                output_directory / f"{output_prefix}-{i:05d}.arrow"
+                for i in range(len(file_paths))
+            ]
+        else:
+            # stream tokenized chunks into an Arrow file next to the output dataset
+            arrow_paths = [output_directory / f"{output_prefix}.arrow"]
 
-           
-        #output_path = (Path(output_directory) / output_prefix).with_suffix(".dataset")
-        output_path = (Path(output_directory) / output_prefix)
-        print("Inside tokeniser function ::: Saving file to...", output_path) 
-        tokenized_dataset.save_to_disk(output_path)
+        try:
+            if n_file_workers > 1:
+                with ProcessPoolExecutor(
+                    max_workers=n_file_workers, mp_context=_mp_context
+                ) as executor:
+                    futures = [
+                        executor.submit(
+                            _tokenize_file_to_arrow,
+                            self,
+                            file_path,
+                            file_format,
+                            arrow_path,
+                            features,
+                        )
+                        for file_path, arrow_path in zip(file_paths, arrow_paths)
+                    ]
+                    for future in futures:
+                        future.result()
+            else:
+                self.create_dataset(
+                    self.tokenize_files(data_directory, file_format),
+                    arrow_paths[0],
+                    features,
+                )
+            tokenized_dataset = concatenate_datasets(
+                [Dataset.from_file(str(arrow_path)) for arrow_path in arrow_paths]
+            )
+
+            #output_path = (Path(output_directory) / output_prefix).with_suffix(".dataset")
+            output_path = (Path(output_directory) / output_prefix)
+            print("Inside tokeniser function ::: Saving file to...", output_path)
+            # clear any earlier run's dataset so the output only holds this one
+            if output_path.exists():
+                shutil.rmtree(output_path)
+            tokenized_dataset.save_to_disk(output_path)
+        finally:
+            # the Arrow shards are intermediates, success or not
+            for arrow_path in arrow_paths:
+                if arrow_path.exists():
+                    arrow_path.unlink()
+
+    def _dataset_features(self, file_path, file_format):
+        """
+        Features of the output dataset: int32 input_ids and length, plus the
+        custom attributes typed from file_path, so that files with no cells
+        passing filters still write a valid (empty) dataset.
+        """
+        features = {"input_ids": Sequence(Value("int32"))}
+        if self.custom_attr_name_dict is not None:
+            if file_format == "loom":
+                with lp.connect(str(file_path), mode="r", validate=False) as data:
+                    attr_types = {
+                        k: pa.array(data.ca[k][:]).type
+                        for k in self.custom_attr_name_dict.keys()
+                    }
+            else:
+                adata = ad.read(file_path, backed="r")
+                attr_types = {
+                    k: pa.array(adata.obs[k].to_numpy()).type
+                    for k in self.custom_attr_name_dict.keys()
+                }
+                adata.file.close()
+            features.update(
+                Features.from_arrow_schema(
+                    pa.schema(
+                        [(self.custom_attr_name_dict[k], t) for k, t in attr_types.items()]
+                    )
+                )
+            )
+        features["length"] = Value("int32")
+        return Features(features)
+
+    def _data_files(self, data_directory, file_format):
+        """
+        Files to tokenize: data_directory itself if it is a file, otherwise the
+        .{file_format} files inside it.
+        """
+        if not data_directory.is_dir():
+            return [data_directory]
+
+        file_paths = sorted(data_directory.glob("*.{}".format(file_format)))
+        if len(file_paths) == 0:
+            logger.error(
+                f"No .{file_format} files found in directory {data_directory}.")
+            raise FileNotFoundError(
+                f"No .{file_format} files found in directory {data_directory}.")
+        return file_paths
 
     def tokenize_files(
         self, data_directory, file_format: Literal["loom", "h5ad"] = "loom"
     ):
-        tokenized_cells = []
-        if self.custom_attr_name_dict is not None:
-            cell_attr = [attr_key for attr_key in self.custom_attr_name_dict.keys()]
-            cell_metadata = {attr_key: [] for attr_key in self.custom_attr_name_dict.values()}
-
+        """
+        Yield (tokenized_cells, cell_metadata) per chunk of cells, with custom
+        attributes renamed to their output dataset column names.
+        """
         tokenize_file_fn = (
             self.tokenize_loom if file_format == "loom" else self.tokenize_anndata
         )
 
-        print(f"Tokenizing {data_directory}")
-        file_tokenized_cells, file_cell_metadata = tokenize_file_fn(data_directory)
+        # loops through data_directory (or the single file given) to tokenize .loom or .h5ad files
+        for file_path in self._data_files(Path(data_directory), file_format):
+            print(f"Tokenizing {file_path}")
+            for tokenized_cells, file_cell_metadata in tokenize_file_fn(file_path):
+                if self.custom_attr_name_dict is not None:
+                    cell_metadata = {
+                        self.custom_attr_name_dict[k]: v
+                        for k, v in file_cell_metadata.items()
+                    }
+                else:
+                    cell_metadata = None
+                yield tokenized_cells, cell_metadata
 
-        if self.custom_attr_name_dict is not None:
-            for k in cell_attr:
-                cell_metadata[self.custom_attr_name_dict[k]] += file_cell_metadata[k]
-        else:
-            cell_metadata = None
-
-        ## remove loop that searches for .loom files 
-        ## loops through directories to tokenize .loom files
-        #file_found = 0
-        ## loops through directories to tokenize .loom or .h5ad files
-        #tokenize_file_fn = (
-        #    self.tokenize_loom if file_format == "loom" else self.tokenize_anndata
-        #)
-        #for file_path in data_directory.glob("*.{}".format(file_format)):
-        #    file_found = 1
-        #    print(f"Tokenizing {file_path}")
-        #    file_tokenized_cells, file_cell_metadata = tokenize_file_fn(file_path)
-        #    tokenized_cells += file_tokenized_cells
-        #    if self.custom_attr_name_dict is not None:
-        #        for k in cell_attr:
-        #            cell_metadata[self.custom_attr_name_dict[k]] += file_cell_metadata[k]
-        #    else:
-        #        cell_metadata = None
-        #
-        #if file_found == 0:
-        #    logger.error(
-        #        f"No .{file_format} files found in directory {data_directory}.")
-        #    raise
-
-        return tokenized_cells, cell_metadata
-
-    def tokenize_anndata(self, adata_file_path, target_sum=10_000, chunk_size=512):
-        adata = ad.read(adata_file_path, backed="r")
+    def _gene_axis_info(self, ensembl_ids):
+        """
+        Coordinates of protein-coding and miRNA genes in ensembl_ids with their
+        normalization factors and tokens, cached for files sharing a gene axis.
+        """
+        ids = np.asarray(ensembl_ids, dtype=str)
+        # fixed-width bytes alone are ambiguous (['a', 'b'] and ['ab'] pack alike),
+        # so the digest also covers the shape and item width
+        digest = hashlib.blake2b(repr((ids.shape, ids.dtype.itemsize)).encode())
+        digest.update(ids.tobytes())
+        key = digest.digest()
+        if key not in self._gene_axis_cache:
+            coding_miRNA_loc = np.flatnonzero(np.isin(ensembl_ids, self._keys_arr))
+            coding_miRNA_ids = ensembl_ids[coding_miRNA_loc]
+            norm_factor_vector = self._median_series.reindex(coding_miRNA_ids).to_numpy()
+            # contiguous int32 lookup indexed by position on the coding/miRNA gene axis;
+            # the ranking kernel gathers from it directly, so keep one dtype (one compiled variant)
+            token_series = self._token_series.reindex(coding_miRNA_ids)
+            if token_series.isna().any():
+                missing = token_series.index[token_series.isna()].tolist()
+                raise KeyError(f"Genes missing from the token dictionary: {missing}")
+            coding_miRNA_tokens = np.ascontiguousarray(token_series.to_numpy(), dtype=np.int32)
+            self._gene_axis_cache[key] = (
+                coding_miRNA_loc,
+                norm_factor_vector,
+                coding_miRNA_tokens,
+            )
+        return self._gene_axis_cache[key]
 
-        if self.custom_attr_name_dict is not None:
-            file_cell_metadata = {
-                attr_key: [] for attr_key in self.custom_attr_name_dict.keys()
-            }
+    def tokenize_anndata(self, adata_file_path, target_sum=10_000, chunk_size=4096):
+        adata = ad.read(adata_file_path, backed="r")
 
-        coding_miRNA_loc = np.where(
-            [self.genelist_dict.get(i, False) for i in adata.var["ensembl_id"]]
-        )[0]
-        norm_factor_vector = np.array(
-            [
-                self.gene_median_dict[i]
-                for i in adata.var["ensembl_id"][coding_miRNA_loc]
-            ]
-        )
-        coding_miRNA_ids = adata.var["ensembl_id"][coding_miRNA_loc]
-        coding_miRNA_tokens = np.array(
-            [self.gene_token_dict[i] for i in coding_miRNA_ids]
+        coding_miRNA_loc, norm_factor_vector, coding_miRNA_tokens = self._gene_axis_info(
+            adata.var["ensembl_id"].to_numpy()
         )
 
         try:
@@ -217,59 +476,43 @@ class TranscriptomeTokenizer:
             var_exists = True
 
         if var_exists:
-            filter_pass_loc = np.where(
-                [i == 1 for i in adata.obs["filter_pass"]]
-            )[0]
+            filter_pass_loc = np.flatnonzero(adata.obs["filter_pass"].to_numpy() == 1)
         elif not var_exists:
             print(
                 f"{adata_file_path} has no column attribute 'filter_pass'; tokenizing all cells."
             )
-            filter_pass_loc = np.array([i for i in range(adata.shape[0])])
-
-        tokenized_cells = []
+            filter_pass_loc = np.arange(adata.shape[0], dtype=np.int64)
 
-        for i in range(0, len(filter_pass_loc), chunk_size):
-            idx = filter_pass_loc[i:i+chunk_size]
-
-            n_counts = adata[idx].obs['n_counts'].values[:, None]
-            X_view = adata[idx, coding_miRNA_loc].X
-            X_norm = (X_view / n_counts * target_sum / norm_factor_vector)
-            X_norm = sp.csr_matrix(X_norm)
-
-            tokenized_cells += [
-                rank_genes(X_norm[i].data, coding_miRNA_tokens[X_norm[i].indices])
-                for i in range(X_norm.shape[0])
-            ]
-
-            # add custom attributes for subview to dict
-            if self.custom_attr_name_dict is not None:
-                for k in file_cell_metadata.keys():
-                    file_cell_metadata[k] += adata[idx].obs[k].tolist()
-            else:
-                file_cell_metadata = None
-
-        return tokenized_cells, file_cell_metadata
-
-    def tokenize_loom(self, loom_file_path, target_sum=10_000):
+        # read per-cell columns once rather than re-slicing the backed file per chunk
+        n_counts = adata.obs["n_counts"].to_numpy()
         if self.custom_attr_name_dict is not None:
-            file_cell_metadata = {
-                attr_key: [] for attr_key in self.custom_attr_name_dict.keys()
+            cell_attr_values = {
+                k: adata.obs[k].to_numpy() for k in self.custom_attr_name_dict.keys()
             }
+        else:
+            cell_attr_values = None
+
+        # workers open their own read-only handles
+        adata.file.close()
+
+        return self._tokenize_chunks(
+            adata_file_path,
+            "h5ad",
+            filter_pass_loc,
+            chunk_size,
+            coding_miRNA_loc,
+            coding_miRNA_tokens,
+            norm_factor_vector,
+            target_sum,
+            n_counts,
+            cell_attr_values,
+        )
 
+    def tokenize_loom(self, loom_file_path, target_sum=10_000, chunk_size=4096):
         with lp.connect(str(loom_file_path)) as data:
             # define coordinates of detected protein-coding or miRNA genes and vector of their normalization factors
-            coding_miRNA_loc = np.where(
-                [self.genelist_dict.get(i, False) for i in data.ra["ensembl_id"]]
-            )[0]
-            norm_factor_vector = np.array(
-                [
-                    self.gene_median_dict[i]
-                    for i in data.ra["ensembl_id"][coding_miRNA_loc]
-                ]
-            )
-            coding_miRNA_ids = data.ra["ensembl_id"][coding_miRNA_loc]
-            coding_miRNA_tokens = np.array(
-                [self.gene_token_dict[i] for i in coding_miRNA_ids]
+            coding_miRNA_loc, norm_factor_vector, coding_miRNA_tokens = self._gene_axis_info(
+                data.ra["ensembl_id"]
             )
 
             # define coordinates of cells passing filters for inclusion (e.g. QC)
@@ -281,124 +524,164 @@ class TranscriptomeTokenizer:
                 var_exists = True
 
             if var_exists:
-                filter_pass_loc = np.where(
-                    [i == 1 for i in data.ca["filter_pass"]]
-                )[0]
+                filter_pass_loc = np.flatnonzero(np.asarray(data.ca["filter_pass"]) == 1)
             elif not var_exists:
                 print(
                     f"{loom_file_path} has no column attribute 'filter_pass'; tokenizing all cells."
                 )
-                filter_pass_loc = np.array([i for i in range(data.shape[1])])
-
-            # scan through .loom files and tokenize cells
-            tokenized_cells = []
-            for (_ix, _selection, view) in data.scan(items=filter_pass_loc, axis=1):
-                # select subview with protein-coding and miRNA genes
-                subview = view.view[coding_miRNA_loc, :]
-
-                # normalize by total counts per cell and multiply by 10,000 to allocate bits to precision
-                # and normalize by gene normalization factors
-                subview_norm_array = (
-                    subview[:, :]
-                    / subview.ca.n_counts
-                    * target_sum
-                    / norm_factor_vector[:, None]
-                )
-                # tokenize subview gene vectors
-                tokenized_cells += [
-                    tokenize_cell(subview_norm_array[:, i], coding_miRNA_tokens)
-                    for i in range(subview_norm_array.shape[1])
-                ]
+                filter_pass_loc = np.arange(data.shape[1], dtype=np.int64)
 
-                # add custom attributes for subview to dict
-                if self.custom_attr_name_dict is not None:
-                    for k in file_cell_metadata.keys():
-                        file_cell_metadata[k] += subview.ca[k].tolist()
-                else:
-                    file_cell_metadata = None
+            # read per-cell attributes once rather than per scanned batch
+            n_counts = data.ca["n_counts"][:]
+            if self.custom_attr_name_dict is not None:
+                cell_attr_values = {
+                    k: data.ca[k][:] for k in self.custom_attr_name_dict.keys()
+                }
+            else:
+                cell_attr_values = None
+
+        return self._tokenize_chunks(
+            loom_file_path,
+            "loom",
+            filter_pass_loc,
+            chunk_size,
+            coding_miRNA_loc,
+            coding_miRNA_tokens,
+            norm_factor_vector,
+            target_sum,
+            n_counts,
+            cell_attr_values,
+        )
 
-        return tokenized_cells, file_cell_metadata
+    def _tokenize_chunks(
+        self,
+        file_path,
+        file_format,
+        filter_pass_loc,
+        chunk_size,
+        coding_miRNA_loc,
+        coding_miRNA_tokens,
+        norm_factor_vector,
+        target_sum,
+        n_counts,
+        cell_attr_values,
+    ):
+        """
+        Split filter_pass_loc into blocks of about chunk_size cells and tokenize
+        them across self.nproc worker processes, yielding (tokenized_cells,
+        file_cell_metadata) per chunk in file order.
+        """
+        # chunks end on read-window boundaries so no window is read by two chunks
+        idx_blocks = _window_blocks(filter_pass_loc, chunk_size)
+        chunks = [(idx, n_counts[idx]) for idx in idx_blocks]
+        initargs = (
+            file_path,
+            file_format,
+            coding_miRNA_loc,
+            coding_miRNA_tokens,
+            norm_factor_vector,
+            target_sum,
+        )
 
-    def create_dataset(self, tokenized_cells, cell_metadata, use_generator=False, keep_uncropped_input_ids=False):
-        print("Creating dataset.")
-        # create dict for dataset creation
-        dataset_dict = {"input_ids": tokenized_cells}
-        if self.custom_attr_name_dict is not None:
-            dataset_dict.update(cell_metadata)
-
-        # create dataset
-        if use_generator:
-            def dict_generator():
-                for i in range(len(tokenized_cells)):
-                    yield {k: dataset_dict[k][i] for k in dataset_dict.keys()}
-            output_dataset = Dataset.from_generator(dict_generator, num_proc=self.nproc)
+        if self.nproc > 1:
+            # imap (not imap_unordered) so cells stay aligned with their metadata
+            with _mp_context.Pool(
+                processes=self.nproc,
+                initializer=_init_chunk_worker,
+                initargs=initargs,
+            ) as pool:
+                tokenized_chunks = pool.imap(_tokenize_chunk, chunks)
+                yield from self._attach_metadata(tokenized_chunks, idx_blocks, cell_attr_values)
         else:
-            output_dataset = Dataset.from_dict(dataset_dict)
-            
-        def format_cell_features(example):
-            # Store original uncropped input_ids in separate feature
-            if keep_uncropped_input_ids:
-                example['input_ids_uncropped'] = example['input_ids']
-                example['length_uncropped'] = len(example['input_ids'])
-
-            # Truncate/Crop input_ids to size 2,048
-            example['input_ids'] = example['input_ids'][0:2048]
-            example['length'] = len(example['input_ids'])
-
-            return example
-
-        output_dataset_truncated = output_dataset.map(
-            format_cell_features,
-            num_proc=self.nproc
-        )
-        return output_dataset_truncated
+            _init_chunk_worker(*initargs)
+            try:
+                tokenized_chunks = map(_tokenize_chunk, chunks)
+                yield from self._attach_metadata(tokenized_chunks, idx_blocks, cell_attr_values)
+            finally:
+                _close_chunk_worker()
+
+    def _attach_metadata(self, tokenized_chunks, idx_blocks, cell_attr_values):
+        """
+        Pair each chunk's tokenized cells with its slice of the custom attributes.
+        """
+        for tokenized_cells, idx in zip(tokenized_chunks, idx_blocks):
+            if cell_attr_values is not None:
+                file_cell_metadata = {
+                    k: v[idx].tolist() for k, v in cell_attr_values.items()
+                }
+            else:
+                file_cell_metadata = None
+            yield tokenized_cells, file_cell_metadata
+
+    def create_dataset(self, tokenized_chunks, arrow_path, features):
+        """
+        Write (tokenized_cells, cell_metadata) chunks to arrow_path as they are
+        produced, cast to features.
+        """
+        print("Creating dataset.")
+        writer = ArrowWriter(features=features, path=str(arrow_path))
+        try:
+            for tokenized_cells, cell_metadata in tokenized_chunks:
+                # input_ids are already cropped to 2,048 tokens by tokenize_csr
+                columns = {"input_ids": tokenized_cells}
+                if cell_metadata is not None:
+                    columns.update(cell_metadata)
+                columns["length"] = pc.list_value_length(tokenized_cells)
+                writer.write_table(pa.table(columns))
+            writer.finalize()
+        finally:
+            writer.close()
 
 print("Tokenizer functions successfully defined.")
 
 ###############################
 # run tokenise.py
 ###############################
-print("Running tokenise.py...")
-import os
-import scanpy
-import anndata
+if __name__ == "__main__":
+    print("Running tokenise.py...")
+    import os
+    import scanpy
+    import anndata
 
 
 
-# Inputs / Ouputs
-token_outprefix=sys.argv[1]
-loom_outpath=os.getcwd()  + "/"+ token_outprefix # This to get the cromwell-root/
-print("Outside tokeniser function ::: Path to where we save the data: \n" \
-            + loom_outpath + "\n" \
-            + token_outprefix + "\n")
+    # Inputs / Ouputs
+    token_outprefix=sys.argv[1]
+    loom_outpath=os.getcwd()  + "/"+ token_outprefix # This to get the cromwell-root/
+    print("Outside tokeniser function ::: Path to where we save the data: \n" \
+                + loom_outpath + "\n" \
+                + token_outprefix + "\n")
 
-loom_inpath=sys.argv[2]
-print("loom_inpath: \n" + loom_inpath)
+    loom_inpath=sys.argv[2]
+    print("loom_inpath: \n" + loom_inpath)
 
 
 
-# Get Tokeniser instance, and call data tokeniser method
-print("Running tk.tokenize_data on: \n" \
-       + loom_inpath + "\n" \
-       + loom_outpath + "\n" \
-       + token_outprefix + "\n")
-tk = TranscriptomeTokenizer(nproc=1)
-tk.tokenize_data(loom_inpath, loom_outpath, token_outprefix)
+    # Get Tokeniser instance, and call data tokeniser method
+    print("Running tk.tokenize_data on: \n" \
+           + loom_inpath + "\n" \
+           + loom_outpath + "\n" \
+           + token_outprefix + "\n")
+    # worker processes: the task's cpu count from the WDL, as os.cpu_count() reports the
+    # host's cores regardless of the task's cpu or container limits
+    nproc = min(int(sys.argv[5]), os.cpu_count()) if len(sys.argv) > 5 else 1
+    tk = TranscriptomeTokenizer(nproc=nproc)
+    tk.tokenize_data(loom_inpath, loom_outpath, token_outprefix)
 
 
 
-# Checks
-print("Python -- pwd:")
-print(os.getcwd())
+    # Checks
+    print("Python -- pwd:")
+    print(os.getcwd())
 
-print("Python -- contents of current dir:")
-print(os.listdir(loom_outpath))
+    print("Python -- contents of current dir:")
+    print(os.listdir(loom_outpath))
 
-print("Python -- contents of dataset dir:")
-print(os.listdir(loom_outpath+"/"+token_outprefix))
+    print("Python -- contents of dataset dir:")
+    print(os.listdir(loom_outpath+"/"+token_outprefix))
 
-print('DATA HAS BEEN TOKENIZED...\n')
-print('SUCCESS')
+    print('DATA HAS BEEN TOKENIZED...\n')
+    print('SUCCESS')
 
 # -------------------------------------------------------------------
 